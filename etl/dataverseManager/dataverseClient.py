@@ -4,12 +4,13 @@ import logging
 import requests
 import time
 import os
+import uuid
 
 from irodsManager.irodsUtils import get_zip_generator, zip_generator_faker, ExporterClient, ExporterState as Status
 
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.fields import RequestField
 from http import HTTPStatus
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger('iRODS to Dataverse')
 
@@ -34,8 +35,8 @@ class DataverseClient(ExporterClient):
         self.session = irodsclient.session
         self.rulemanager = irodsclient.rulemanager
 
-        self.pool = None
-        self.pool_result = None
+        self.executor = None
+        self.checksum_future = None
         self.irods_md5 = None
 
         self.dataset_deposit_url = None
@@ -86,8 +87,8 @@ class DataverseClient(ExporterClient):
 
         if self.dataset_deposit_url is not None:
             self.irods_client.update_metadata_status(Status.CREATE_DATASET.value, Status.PREPARE_COLLECTION.value)
-            self.pool = Pool(processes=1)
-            self.pool_result = self.pool.apply_async(self.run_checksum, [self.irods_client.coll.path])
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.checksum_future = self.executor.submit(self.run_checksum, self.irods_client.coll.path)
 
             size_bundle = self._prepare_zip()
             response = self._upload_zip_collection(size_bundle)
@@ -108,10 +109,8 @@ class DataverseClient(ExporterClient):
         logger.info(f"{'--':<10}Prepare zip")
 
         self.irods_client.update_metadata_status(Status.PREPARE_COLLECTION.value, Status.ZIP_COLLECTION.value)
-        irods_md5 = hashlib.md5()
-        size_bundle = zip_generator_faker(self.irods_client, self.upload_success, irods_md5, self.restrict_list)
-        md5_hexdigest = irods_md5.hexdigest()
-        logger.info(f"{'--':<20}Buffer faker MD5: {md5_hexdigest}")
+        size_bundle = zip_generator_faker(self.irods_client, self.restrict_list)
+        logger.info(f"{'--':<20}Buffer faker size: {size_bundle}")
 
         return size_bundle
 
@@ -120,18 +119,28 @@ class DataverseClient(ExporterClient):
 
         self.irods_client.update_metadata_status(Status.ZIP_COLLECTION.value, Status.UPLOAD_ZIPPED_COLLECTION.value)
         self.irods_md5 = hashlib.md5()
-        bundle_iterator = get_zip_generator(self.irods_client, self.upload_success,
-                                            self.irods_md5, self.restrict_list, size_bundle)
+
+        # Frame the multipart body by hand so the zip chunks are streamed as they are produced
+        boundary = uuid.uuid4().hex
         json_data = {"restrict": self.restrict}
-        multipart_encoder = MultipartEncoder(
-            fields={'jsonData': json.dumps(json_data),
-                    'file': (self.zip_name, bundle_iterator)
-                    }
-        )
+        json_field = RequestField(name='jsonData', data=json.dumps(json_data))
+        json_field.make_multipart()
+        file_field = RequestField(name='file', data=b'', filename=self.zip_name)
+        file_field.make_multipart()
+        prologue = (f'--{boundary}\r\n'
+                    f'{json_field.render_headers()}'
+                    f'{json_field.data}\r\n'
+                    f'--{boundary}\r\n'
+                    f'{file_field.render_headers()}'
+                    ).encode('utf-8')
+        epilogue = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        bundle_iterator = get_zip_generator(self.irods_client, self.upload_success,
+                                            self.irods_md5, self.restrict_list, size_bundle,
+                                            prologue, epilogue)
         resp = requests.post(
             self.dataset_deposit_url,
-            data=multipart_encoder,
-            headers={'Content-Type': multipart_encoder.content_type,
+            data=bundle_iterator,
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}',
                      'X-Dataverse-key': self.token
                      },
         )
@@ -142,9 +151,8 @@ class DataverseClient(ExporterClient):
         logger.info(f"{'--':<10}Validate checksum")
 
         self.irods_client.update_metadata_status(Status.UPLOAD_ZIPPED_COLLECTION.value, Status.VALIDATE_CHECKSUM.value)
-        self.pool.close()
-        self.pool.join()
-        chksums = self.pool_result.get()
+        chksums = self.checksum_future.result()
+        self.executor.shutdown()
         count = 0
         validated = False
         for k in self.upload_success.keys():
@@ -189,6 +197,7 @@ class DataverseClient(ExporterClient):
         logger.info(f"{'--':<10}Report final progress")
         self.irods_client.add_metadata('externalPID', self.dataset_pid, "Dataverse")
         self.irods_client.update_metadata_status(Status.FINALIZE.value, Status.EXPORTED.value)
+        # Keep the exported state visible to the observers polling exporterState
         time.sleep(5)
         self.irods_client.remove_metadata(Status.ATTRIBUTE.value, f"Dataverse:{Status.EXPORTED.value}")
         logger.info(f"{'--':<10}Export Done")
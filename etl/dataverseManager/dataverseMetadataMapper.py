@@ -1,6 +1,9 @@
+import functools
 import json
 import logging
 
+from urllib.parse import urlsplit
+
 logger = logging.getLogger('iRODS to Dataverse')
 
 '''
@@ -9,92 +12,156 @@ self.protocol = None
  '''
 
 
+_SUBJECT = {
+    "typeName": "subject",
+    "multiple": True,
+    "value": [
+        "Medicine, Health and Life Sciences"
+    ],
+    "typeClass": "controlledVocabulary"
+}
+
+
+def _primitive(type_name, value, type_class="primitive"):
+    return {"typeName": type_name, "multiple": False, "value": value, "typeClass": type_class}
+
+
+def _compound(type_name, value):
+    return {"typeName": type_name, "multiple": True, "value": value, "typeClass": "compound"}
+
+
+def _make_keyword(value, vocabulary, uri):
+    return {
+        "keywordValue": _primitive("keywordValue", value),
+        "keywordVocabulary": _primitive("keywordVocabulary", vocabulary),
+        "keywordVocabularyURI": _primitive("keywordVocabularyURI", uri)
+    }
+
+
+def _make_publication(value, doi, url):
+    return {
+        "publicationIDNumber": _primitive("publicationIDNumber", value),
+        "publicationIDType": _primitive("publicationIDType", doi, "controlledVocabulary"),
+        "publicationURL": _primitive("publicationURL", url)
+    }
+
+
+def _make_article_publication(url):
+    parts = urlsplit(url)
+    # e.g. https://doi.org/10.1000/xyz123 -> ("10.1000xyz123", "doi")
+    id_type = parts.netloc[:-len(".org")] if parts.netloc.endswith(".org") else parts.netloc
+    path = parts.path.split("/", 3)
+    return _make_publication(path[1] + path[2], id_type, url)
+
+
+class _LazyJSON:
+    """Pretty-print an object only when a log record using it is emitted, at most once.
+    """
+    __slots__ = ('obj', 'text')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = json.dumps(self.obj, indent=4)
+        return self.text
+
+
+@functools.lru_cache(maxsize=1)
+def load_template():
+    """Read the Dataverse dataset template once, every mapping parses its own copy from these bytes.
+
+    :return: bytes - content of resources/template.json
+    """
+    with open('resources/template.json', 'rb') as f:
+        return f.read()
+
+
 class MetadataMapper:
     """Map iRODS metadata to the Open Access Repository metadata format
     """
+    __slots__ = ('imetadata', 'dataset_json', 'md', 'fields')
+
     def __init__(self, imetadata, depositor):
         self.imetadata = imetadata
         self.dataset_json = None
         self.md = None
+        self.fields = None
         self.imetadata.depositor = depositor
 
     def read_metadata(self):
         logger.info("--\t Map metadata")
 
-        with open('resources/template.json') as f:
-            self.dataset_json = json.load(f)
+        return self.build(json.loads(load_template()))
+
+    def build(self, template):
+        """Map the iRODS metadata into a parsed dataset template.
+        The template is filled in place and returned, so batch callers can parse it once and pass copies.
+
+        :param dict template: parsed resources/template.json
+        :return: dict - Dataverse dataset JSON
+        """
+
+        imetadata = self.imetadata
+        self.dataset_json = template
 
         self.md = self.dataset_json['datasetVersion']
+        self.fields = self.md["metadataBlocks"]["citation"]["fields"]
 
-        pid = self.imetadata.pid.split("/")
-        self.update_pid(self.md, pid[0], pid[1])
+        authority, _, identifier = imetadata.pid.partition("/")
+        self.update_pid(self.md, authority, identifier)
 
-        author = self.imetadata.creator.split("@")[0]
+        author = imetadata.creator.split("@")[0]
         self.add_author(author)
 
-        url = f"https://hdl.handle.net/{self.imetadata.pid}"
+        url = f"https://hdl.handle.net/{imetadata.pid}"
         self.add_alternative_url(url)
 
-        if self.imetadata.description is None:
+        if imetadata.description is None:
             self.add_description("")
         else:
-            self.add_description(self.imetadata.description)
+            self.add_description(imetadata.description)
 
-        self.add_date(self.imetadata.date)
+        self.add_date(imetadata.date)
 
-        self.add_title(self.imetadata.title)
+        self.add_title(imetadata.title)
 
         self.add_subject()
 
         contacts = []
-        contact_email = self.add_contact_email(self.imetadata.creator)
+        contact_email = self.add_contact_email(imetadata.creator)
         contacts.append(contact_email)
 
-        for c in self.imetadata.contact:
-            if len(c) != 0:
+        add_contact = self.add_contact
+        contacts_append = contacts.append
+        for c in imetadata.contact:
+            if c:
                 if c.get("email") is None:
                     c.update({"email": ""})
                 if c.get("affiliation") is None:
                     c.update({"affiliation": ""})
-                pub = self.add_contact(c.get("firstName") + " " + c.get("lastName"), c.get("email"),
-                                       c.get("affiliation"))
-                contacts.append(pub)
+                pub = add_contact(c.get("firstName") + " " + c.get("lastName"), c.get("email"),
+                                  c.get("affiliation"))
+                contacts_append(pub)
 
         self.add_contacts(contacts)
 
         keywords = []
-        if self.imetadata.tissue:
-            keyword = self.add_keyword(self.imetadata.tissue.get("name"), self.imetadata.tissue.get("vocabulary"),
-                                       self.imetadata.tissue.get("uri"))
-            keywords.append(keyword)
-
-        if self.imetadata.technology:
-            keyword = self.add_keyword(self.imetadata.technology.get("name"),
-                                       self.imetadata.technology.get("vocabulary"),
-                                       self.imetadata.technology.get("uri"))
-            keywords.append(keyword)
-
-        if self.imetadata.organism:
-            keyword = self.add_keyword(self.imetadata.organism.get("name"), self.imetadata.organism.get("vocabulary"),
-                                       self.imetadata.organism.get("uri"))
-            keywords.append(keyword)
-
-        for f in self.imetadata.factors:
-            keyword = self.add_keyword(f, "", "")
-            keywords.append(keyword)
+        for tag in (imetadata.tissue, imetadata.technology, imetadata.organism):
+            if tag:
+                keywords.append(_make_keyword(tag["name"], tag["vocabulary"], tag["uri"]))
+
+        keywords += [_make_keyword(f, "", "") for f in imetadata.factors]
 
         self.add_keywords(keywords)
 
-        publications = []
-        for f in self.imetadata.articles:
-            info = f.split("/")
-            pub = self.add_publication(info[3] + info[4], info[2].strip(".org"), f)
-            publications.append(pub)
+        publications = [_make_article_publication(f) for f in imetadata.articles]
 
         self.add_publications(publications)
 
-        self.dataset_json['datasetVersion'] = self.md
-        logger.debug(json.dumps(self.dataset_json, indent=4))
+        logger.debug("%s", _LazyJSON(self.dataset_json))
 
         return self.dataset_json
 
@@ -105,97 +172,50 @@ class MetadataMapper:
         md["identifier"] = identifier
 
     def update_fields(self, new):
-        fields = self.md["metadataBlocks"]["citation"]["fields"]
-        fields.append(new)
+        self.fields.append(new)
 
     def add_author(self, author, affiliation="", up=True):
-        new = {
-            "typeName": "author",
-            "multiple": True,
-            "value": [
-                {
-                    "authorAffiliation": {
-                        "typeName": "authorAffiliation",
-                        "multiple": False,
-                        "value": affiliation,
-                        "typeClass": "primitive"
-                    },
-                    "authorName": {
-                        "typeName": "authorName",
-                        "multiple": False,
-                        "value": author,
-                        "typeClass": "primitive"
-                    }
-                }
-            ],
-            "typeClass": "compound"
-        }
+        new = _compound("author", [
+            {
+                "authorAffiliation": _primitive("authorAffiliation", affiliation),
+                "authorName": _primitive("authorName", author)
+            }
+        ])
         if up:
             self.update_fields(new)
         return new
 
     def add_title(self, title, up=True):
-        new = {
-            "typeName": "title",
-            "multiple": False,
-            "value": title,
-            "typeClass": "primitive"
-        }
+        new = _primitive("title", title)
         if up:
             self.update_fields(new)
         return new
 
     def add_description(self, description, up=True):
-        new = {
-            "typeName": "dsDescription",
-            "multiple": True,
-            "value": [
-                {
-                    "dsDescriptionValue": {
-                        "typeName": "dsDescriptionValue",
-                        "multiple": False,
-                        "value": description,
-                        "typeClass": "primitive"
-                    }
-                }
-            ],
-            "typeClass": "compound"
-        }
+        new = _compound("dsDescription", [
+            {
+                "dsDescriptionValue": _primitive("dsDescriptionValue", description)
+            }
+        ])
         if up:
             self.update_fields(new)
         return new
 
     def add_subject(self, up=True):
-        new = {
-            "typeName": "subject",
-            "multiple": True,
-            "value": [
-                "Medicine, Health and Life Sciences"
-            ],
-            "typeClass": "controlledVocabulary"
-        }
+        # Constant field, shared by all the mappings: never mutated after being added
+        new = _SUBJECT
         if up:
             self.update_fields(new)
         return new
 
     def add_date(self, date, up=True):
-        new = {
-            "typeName": "dateOfDeposit",
-            "multiple": False,
-            "value": date,
-            "typeClass": "primitive"
-        }
+        new = _primitive("dateOfDeposit", date)
         if up:
             self.update_fields(new)
         return new
 
     def add_contacts(self, contacts, up=True):
-        new = {
-            "typeName": "datasetContact",
-            "multiple": True,
-            "value": contacts,
-            "typeClass": "compound"
-        }
+        new = _compound("datasetContact", contacts)
         if up:
             self.update_fields(new)
         return new
@@ -203,116 +223,37 @@ class MetadataMapper:
     @staticmethod
     def add_contact_email(email):
         new = {
-            "datasetContactEmail": {
-                "typeName": "datasetContactEmail",
-                "multiple": False,
-                "value": email,
-                "typeClass": "primitive"
-            }
+            "datasetContactEmail": _primitive("datasetContactEmail", email)
         }
         return new
 
     @staticmethod
     def add_contact(name, email, affiliation):
         new = {
-            "datasetContactAffiliation": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "datasetContactAffiliation",
-                "value": affiliation
-            },
-            "datasetContactEmail": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "datasetContactEmail",
-                "value": email
-            },
-            "datasetContactName": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "datasetContactName",
-                "value": name
-            }
+            "datasetContactAffiliation": _primitive("datasetContactAffiliation", affiliation),
+            "datasetContactEmail": _primitive("datasetContactEmail", email),
+            "datasetContactName": _primitive("datasetContactName", name)
         }
         return new
 
     def add_keywords(self, keywords, up=True):
-        new = {
-            "multiple": True,
-            "typeClass": "compound",
-            "typeName": "keyword",
-            "value": keywords
-        }
+        new = _compound("keyword", keywords)
         if up:
             self.update_fields(new)
         return new
 
-    @staticmethod
-    def add_keyword(value, vocabulary, uri):
-        new = {
-            "keywordValue": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "keywordValue",
-                "value": value
-            },
-            "keywordVocabulary": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "keywordVocabulary",
-                "value": vocabulary
-            },
-            "keywordVocabularyURI": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "keywordVocabularyURI",
-                "value": uri
-            }
-        }
-        return new
+    add_keyword = staticmethod(_make_keyword)
 
     def add_alternative_url(self, url, up=True):
-        new = {
-            "multiple": False,
-            "typeClass": "primitive",
-            "typeName": "alternativeURL",
-            "value": url
-        }
+        new = _primitive("alternativeURL", url)
         if up:
             self.update_fields(new)
         return new
 
     def add_publications(self, publications, up=True):
-        new = {
-            "multiple": True,
-            "typeClass": "compound",
-            "typeName": "publication",
-            "value": publications
-        }
+        new = _compound("publication", publications)
         if up:
             self.update_fields(new)
         return new
 
-    @staticmethod
-    def add_publication(value, doi, url):
-        new = {
-            "publicationIDNumber": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "publicationIDNumber",
-                "value": value
-            },
-            "publicationIDType": {
-                "multiple": False,
-                "typeClass": "controlledVocabulary",
-                "typeName": "publicationIDType",
-                "value": doi
-            },
-            "publicationURL": {
-                "multiple": False,
-                "typeClass": "primitive",
-                "typeName": "publicationURL",
-                "value": url
-            }
-        }
-        return new
+    add_publication = staticmethod(_make_publication)
@@ -23,7 +23,7 @@ class DataverseExporter:
                            data['data_export'], data['restrict_list'])
         except:
             # Warning: catch all the unexpected error during export to perform clean-up
-            print("Unexpected error:", sys.exc_info()[0])
+            logger.error("Unexpected error: %s", sys.exc_info()[0])
             # Remove all temporary progress export AVU
             self.irods_client.status_cleanup()
             # Still raise the error
@@ -5,7 +5,7 @@ import time
 
 from irodsManager.irodsUtils import get_bag_generator, bag_generator_faker, ExporterClient, ExporterState as Status
 from http import HTTPStatus
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 
 logger = logging.getLogger('iRODS to Dataverse')
@@ -39,8 +39,8 @@ class EasyClient(ExporterClient):
         self.dataset_pid = None
         self.last_export = None
 
-        self.pool = None
-        self.result = None
+        self.executor = None
+        self.checksum_future = None
         # self.bag_md5 = None
 
         self.upload_success = {}
@@ -56,8 +56,8 @@ class EasyClient(ExporterClient):
 
         self.irods_client.update_metadata_state('create-exporter', 'prepare-bag')
 
-        self.pool = Pool(processes=1)
-        self.result = self.pool.apply_async(self.run_checksum, [self.collection.path])
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.checksum_future = self.executor.submit(self.run_checksum, self.collection.path)
 
         irods_md5 = hashlib.md5()
         bag_size = bag_generator_faker(self.irods_client, self.upload_success, irods_md5)
@@ -66,9 +66,8 @@ class EasyClient(ExporterClient):
         logger.info(f"{'--':<20}iRODS buffer MD5: {md5_hexdigest}")
 
         self.irods_client.update_metadata_state('prepare-bag', Status.VALIDATE_CHECKSUM.value)
-        self.pool.close()
-        self.pool.join()
-        chksums = self.result.get()
+        chksums = self.checksum_future.result()
+        self.executor.shutdown()
         count = 0
         # validated = False
         for k in self.upload_success.keys():
@@ -1,21 +1,30 @@
 import hashlib
 import io
+import queue
 import re
 import zipfile
 import logging
 import datetime
+import sys
+import threading
+import time
 
 from irodsManager.irodsRuleManager import RuleManager
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from tqdm import tqdm
 from io import RawIOBase
-from requests_toolbelt.multipart.encoder import CustomBytesIO, encode_with
+from requests_toolbelt.multipart.encoder import CustomBytesIO
 from requests.utils import super_len
 from xml.etree import ElementTree
 
 logger = logging.getLogger('iRODS to Dataverse')
 BLOCK_SIZE = 1024 * io.DEFAULT_BUFFER_SIZE
+# Bytes accumulated before the progress monitor is refreshed
+BAR_UPDATE_SIZE = 64 * 1024 * 1024
+# Blocks read ahead from iRODS while the previous one is compressed
+PREFETCH_DEPTH = 2
 
 date_iso = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
 date = datetime.datetime.now().date()
@@ -30,29 +39,25 @@ class IteratorAsBinaryFile(object):
     <requests_toolbelt.streaming_iterator>
     """
 
-    def __init__(self, size, iterator, md5, encoding='utf-8'):
+    def __init__(self, size, iterator):
         #: The expected size of the upload
         self.size = int(size)
-        self.md5 = md5
         if self.size < 0:
             raise ValueError('The size of the upload must be a positive integer')
 
         #: Attribute that requests will check to determine the length of the
         #: body. See bug #80 for more details
         self.len = self.size
-        #: The iterator used to generate the upload data
+        #: The iterator used to generate the upload data, yielding bytes
         self.iterator = iterator
 
-        #: Encoding the iterator is using
-        self.encoding = encoding
-
         # The buffer we use to provide the correct number of bytes requested
         # during a read
         self._buffer = CustomBytesIO()
 
     def _get_bytes(self):
         try:
-            return encode_with(next(self.iterator), self.encoding)
+            return next(self.iterator)
         except StopIteration:
             return b''
 
@@ -78,7 +83,6 @@ class IteratorAsBinaryFile(object):
         if size < 0:
             self.len = 0
 
-        self.md5.update(s)
         return s
 
 
@@ -87,7 +91,7 @@ class UnseekableStream(RawIOBase):
     """
 
     def __init__(self):
-        self._buffer = b''
+        self._buffer = bytearray()
 
     def writable(self):
         return True
@@ -95,19 +99,53 @@ class UnseekableStream(RawIOBase):
     def write(self, b):
         if self.closed:
             raise ValueError('Stream was closed!')
-        self._buffer += b
+        self._buffer.extend(b)
         return len(b)
 
     def get(self):
-        chunk = self._buffer
-        self._buffer = b''
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
         return chunk
 
 
-def archive_generator_faker(func, stream, bar, irods_md5):
+class RateLimitedBar:
+    """Lightweight progress monitor logging the streamed bytes at most every interval seconds.
+    """
+
+    def __init__(self, total=None, interval=2.0):
+        self.total = total
+        self.interval = interval
+        self.n = 0
+        self.last = time.monotonic()
+
+    def update(self, n):
+        self.n += n
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            if self.total:
+                logger.info(f"{'--':<30}Streamed {self.n} / {self.total} bytes")
+            else:
+                logger.info(f"{'--':<30}Streamed {self.n} bytes")
+
+
+def progress_bar(total):
+    """Return the progress monitor of an archive stream, silent unless debug is set.
+    In debug mode, tqdm on an interactive terminal and a RateLimitedBar on server and CI runs.
+
+    :param int total: expected size in bytes, None if unknown
+    :return: progress monitor with update(n)
+    """
+
+    if debug and not sys.stderr.isatty():
+        return RateLimitedBar(total)
+    return tqdm(total=total, unit="bytes", smoothing=0.1, unit_scale=True, disable=not debug)
+
+
+def archive_generator_faker(func, stream, bar, irods_md5=None):
     """Go through the zip generator and return the size.
 
-    :param irods_md5: md5 checksum hash
+    :param irods_md5: md5 checksum hash, None to only measure the size
     :param func: archive buffer iterator
     :param stream: raw buffer stream
     :param bar: progress monitor
@@ -116,59 +154,220 @@ def archive_generator_faker(func, stream, bar, irods_md5):
 
     try:
         size = 0
+        pending = 0
         if debug:
             with open("debug_archive0.zip", 'wb') as out_fp:
                 for i in func:
                     s = stream.get()
                     if len(s) > 0:
-                        bar.update(len(s))
                         out_fp.write(s)
                         out_fp.flush()
-                        irods_md5.update(s)
+                        if irods_md5 is not None:
+                            irods_md5.update(s)
                         size += len(s)
-            logger.debug("post size " + str(size))
+                        pending += len(s)
+                        if pending >= BAR_UPDATE_SIZE:
+                            bar.update(pending)
+                            pending = 0
+            logger.debug("post size %s", size)
         else:
             for i in func:
                 s = stream.get()
                 if len(s) > 0:
-                    bar.update(len(s))
-                    irods_md5.update(s)
+                    if irods_md5 is not None:
+                        irods_md5.update(s)
                     size += len(s)
+                    pending += len(s)
+                    if pending >= BAR_UPDATE_SIZE:
+                        bar.update(pending)
+                        pending = 0
+        bar.update(pending)
         return size
     except StopIteration:
         return b''
 
 
-def archive_generator(func, stream, bar):
-    """Yield the raw buffer for streaming.
+def make_archive_generator(debug_mode):
+    """Return the archive generator specialised for the logging level.
+    The non-debug generator is the upload hot loop, so it skips the debug dump and hoists the lookups.
 
-    :param func: archive buffer iterator
-    :param stream: raw buffer stream
-    :param bar: progress monitor
-    :return:
+    :param bool debug_mode: also dump the yielded archive to debug_archive00.zip
+    :return: archive generator function(func, stream, bar, irods_md5)
     """
 
-    try:
+    def archive_generator(func, stream, bar, irods_md5):
+        """Yield the raw buffer for streaming.
+
+        :param func: archive buffer iterator
+        :param stream: raw buffer stream
+        :param bar: progress monitor
+        :param irods_md5: md5 checksum hash of the yielded archive
+        :return:
+        """
+
+        get = stream.get
+        update_md5 = irods_md5.update
+        update_bar = bar.update
+        pending = 0
+        for _ in func:
+            s = get()
+            if s:
+                update_md5(s)
+                pending += len(s)
+                if pending >= BAR_UPDATE_SIZE:
+                    update_bar(pending)
+                    pending = 0
+                yield s
+        update_bar(pending)
+
+    def debug_archive_generator(func, stream, bar, irods_md5):
+        """Yield the raw buffer for streaming and dump it to debug_archive00.zip.
+
+        :param func: archive buffer iterator
+        :param stream: raw buffer stream
+        :param bar: progress monitor
+        :param irods_md5: md5 checksum hash of the yielded archive
+        :return:
+        """
+
         size = 0
-        if debug:
-            with open("debug_archive00.zip", 'wb') as out_fp:
-                for i in func:
-                    s = stream.get()
-                    if len(s) > 0:
-                        bar.update(len(s))
-                        out_fp.write(s)
-                        out_fp.flush()
-                        size += len(s)
-                        yield s
-            logger.debug("post size " + str(size))
-        else:
+        pending = 0
+        with open("debug_archive00.zip", 'wb') as out_fp:
             for i in func:
                 s = stream.get()
                 if len(s) > 0:
-                    bar.update(len(s))
+                    out_fp.write(s)
+                    out_fp.flush()
+                    irods_md5.update(s)
+                    size += len(s)
+                    pending += len(s)
+                    if pending >= BAR_UPDATE_SIZE:
+                        bar.update(pending)
+                        pending = 0
                     yield s
-    except StopIteration:
-        return b''
+        bar.update(pending)
+        logger.debug("post size %s", size)
+
+    if debug_mode:
+        return debug_archive_generator
+    return archive_generator
+
+
+def multipart_generator(prologue, iterator, epilogue):
+    """Frame an archive iterator as the file part of a multipart/form-data body.
+
+    :param bytes prologue: multipart headers preceding the file content
+    :param iterator: archive buffer iterator
+    :param bytes epilogue: multipart closing boundary
+    :return:
+    """
+
+    yield prologue
+    yield from iterator
+    yield epilogue
+
+
+def new_block_buffers():
+    """Allocate the read buffers shared by all the read_blocks calls of one archive pass.
+
+    :return: list of PREFETCH_DEPTH + 1 BLOCK_SIZE memoryviews
+    """
+    return [memoryview(bytearray(BLOCK_SIZE)) for _ in range(PREFETCH_DEPTH + 1)]
+
+
+def read_blocks(buff, buffers, hashers=(), size=None):
+    """Yield the content of an opened data object by BLOCK_SIZE blocks.
+    A background thread reads up to PREFETCH_DEPTH blocks ahead and feeds them to the hashers,
+    so the iRODS transfer and the checksums run on another core than the compression done by the caller.
+    Data objects of one block or less are read on the calling thread.
+    The blocks are memoryviews over the recycled buffers, only valid until the next block is requested.
+
+    :param buff: opened iRODS data object
+    :param list buffers: read buffers from new_block_buffers(), reused from one data object to the next
+    :param hashers: hash objects updated with every block
+    :param int size: data object size, if known
+    :return:
+    """
+
+    readinto = getattr(buff, 'readinto', None)
+    if readinto is None:
+        def readinto(view):
+            data = buff.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+
+    if size is not None and size <= BLOCK_SIZE:
+        view = buffers[0]
+        while True:
+            n = readinto(view)
+            if not n:
+                return
+            for hasher in hashers:
+                hasher.update(view[:n])
+            yield view[:n]
+
+    free = queue.Queue()
+    full = queue.Queue()
+    errors = []
+    for view in buffers:
+        free.put(view)
+
+    def producer():
+        while True:
+            view = free.get()
+            if view is None:
+                return
+            try:
+                n = readinto(view)
+                for hasher in hashers:
+                    hasher.update(view[:n])
+            except Exception as error:
+                errors.append(error)
+                n = 0
+            full.put((view, n))
+            if not n:
+                return
+
+    threading.Thread(target=producer, daemon=True).start()
+    try:
+        while True:
+            view, n = full.get()
+            if errors:
+                raise errors[0]
+            if not n:
+                break
+            yield view[:n]
+            free.put(view)
+    finally:
+        # Release the producer if the consumer stops early
+        free.put(None)
+
+
+def open_ahead(session, files):
+    """Yield each data object with its opened iRODS handle.
+    The next data object is opened on a worker thread while the current one is processed,
+    taking the open round-trip off the zip loop.
+
+    :param session: iRODS connection session
+    :param files: iterable of iRODS data objects
+    :return:
+    """
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ahead = None
+        try:
+            for file in files:
+                previous = ahead
+                ahead = file, executor.submit(session.data_objects.open, file.path, 'r')
+                if previous is not None:
+                    yield previous[0], previous[1].result()
+            if ahead is not None:
+                last, ahead = ahead, None
+                yield last[0], last[1].result()
+        finally:
+            # Close the handle opened ahead if the consumer stops early
+            if ahead is not None:
+                ahead[1].result().close()
 
 
 def zip_collection(irods_client, stream, upload_success,  restrict_list):
@@ -178,7 +377,7 @@ def zip_collection(irods_client, stream, upload_success,  restrict_list):
     :param irods_client: iRODS client manager
     :param UnseekableStream stream: raw buffer stream
     :param list restrict_list: list of files path
-    :param dict upload_success: {file_path: hash_key}
+    :param dict upload_success: {file_path: hash_key}, None to skip the chksums
     """
 
     zip_buffer = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
@@ -186,68 +385,72 @@ def zip_collection(irods_client, stream, upload_success,  restrict_list):
 
     collection = irods_client.coll
     session = irods_client.session
-    for coll, sub, files in collection.walk():
-        for file in files:
-            min_path = file.path.replace("/nlmumc/projects/", "")
-            if len(restrict_list) > 0 and (min_path not in restrict_list):
-                continue
-
-            irods_sha = hashlib.sha256()
-            buff = session.data_objects.open(file.path, 'r')
-            root_folder_name = irods_client.imetadata.title.replace(" ", "_")
-            zip_file_path = re.sub(r"/nlmumc/projects/P[0-9]{9}/C[0-9]{9}", root_folder_name, file.path)
-            zip_info = zipfile.ZipInfo(zip_file_path)
-            zip_info.file_size = file.size
-            zip_info.compress_type = zipfile.ZIP_DEFLATED
-            with zip_buffer.open(zip_info, mode='w') as dest:
-                for chunk in iter(lambda: buff.read(BLOCK_SIZE), b''):
-                    dest.write(chunk)
-                    irods_sha.update(chunk)
-                    yield
-            buff.close()
-
-            sha_hexdigest = irods_sha.hexdigest()
+    buffers = new_block_buffers()
+    selected = (file for coll, sub, files in collection.walk() for file in files
+                if len(restrict_list) == 0 or file.path.replace("/nlmumc/projects/", "") in restrict_list)
+    for file, buff in open_ahead(session, selected):
+        hashers = (hashlib.sha256(),) if upload_success is not None else ()
+        root_folder_name = irods_client.imetadata.title.replace(" ", "_")
+        zip_file_path = re.sub(r"/nlmumc/projects/P[0-9]{9}/C[0-9]{9}", root_folder_name, file.path)
+        zip_info = zipfile.ZipInfo(zip_file_path)
+        zip_info.file_size = file.size
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        with zip_buffer.open(zip_info, mode='w') as dest:
+            for chunk in read_blocks(buff, buffers, hashers, file.size):
+                dest.write(chunk)
+                yield
+        buff.close()
+
+        if upload_success is not None:
+            sha_hexdigest = hashers[0].hexdigest()
             upload_success.update({file.path: sha_hexdigest})
 
     zip_buffer.close()
     yield
 
 
-def get_zip_generator(irods_client, upload_success, irods_md5, restrict_list, size) -> IteratorAsBinaryFile:
+def get_zip_generator(irods_client, upload_success, irods_md5, restrict_list, size,
+                      prologue=b'', epilogue=b'') -> IteratorAsBinaryFile:
     """Bundle an iRODS collection into a compressed zip buffer.
     Return the zip buffer iterator.
 
     :param irods_client: iRODS client manager
     :param dict upload_success: {file_path: hash_key}
     :param list restrict_list: list of file's path to include in the zip
-    :param irods_md5: hashlib.md5() object to calculate the md5 checksum
+    :param irods_md5: hashlib.md5() object to calculate the md5 checksum of the zip
     :param int size: estimated zip size
+    :param bytes prologue: optional multipart headers sent before the zip
+    :param bytes epilogue: optional multipart closing boundary sent after the zip
     :return: zip buffer iterator
     """
 
     stream = UnseekableStream()
-    bar = tqdm(total=size, unit="bytes", smoothing=0.1, unit_scale=True, disable=not debug)
+    bar = progress_bar(size)
     zip_iterator = zip_collection(irods_client, stream, upload_success, restrict_list)
-    iterator = IteratorAsBinaryFile(size, archive_generator(zip_iterator, stream, bar), irods_md5)
+    archive_generator = make_archive_generator(debug)
+    bundle = archive_generator(zip_iterator, stream, bar, irods_md5)
+    if prologue or epilogue:
+        bundle = multipart_generator(prologue, bundle, epilogue)
+        size += len(prologue) + len(epilogue)
+    iterator = IteratorAsBinaryFile(size, bundle)
 
     return iterator
 
 
-def zip_generator_faker(irods_client, upload_success, irods_md5, restrict_list) -> int:
+def zip_generator_faker(irods_client, restrict_list) -> int:
     """Fake the zip creation and estimate the size of the compressed zip buffer.
     Return the estimated size.
+    Checksums are left to the real upload pass.
 
     :param irods_client: iRODS client manager
-    :param dict upload_success: {file_path: hash_key}
     :param list restrict_list: list of file's path to include in the zip
-    :param irods_md5: hashlib.md5() object to calculate the md5 checksum
     :return: estimated zip size
     """
 
     stream = UnseekableStream()
-    bar = tqdm(total=1000, unit="bytes", smoothing=0.1, unit_scale=True, disable=not debug)
-    zip_iterator = zip_collection(irods_client, stream, upload_success, restrict_list)
-    size_bundle = archive_generator_faker(zip_iterator, stream, bar, irods_md5)
+    bar = progress_bar(None)
+    zip_iterator = zip_collection(irods_client, stream, None, restrict_list)
+    size_bundle = archive_generator_faker(zip_iterator, stream, bar)
 
     return size_bundle
 
@@ -270,32 +473,30 @@ def bag_collection(irods_client, stream, upload_success):
     checksum_list = []
     total_bytes = 0
     total_files = 0
-    for coll, sub, files in collection.walk():
-        for f in files:
-            total_files += 1
-            buff = session.data_objects.open(f.path, 'r')
-            arc_name = f.path.replace(collection.path, f'{collection.name}/data')
-            zip_info = zipfile.ZipInfo(arc_name)
-            zip_info.file_size = f.size
-            zip_info.compress_type = zipfile.ZIP_DEFLATED
-            irods_sha256 = hashlib.sha256()
-            irods_sha1 = hashlib.sha1()
-            with zip_buffer.open(zip_info, mode='w') as dest:
-                for chunk in iter(lambda: buff.read(BLOCK_SIZE), b''):
-                    dest.write(chunk, )
-                    irods_sha256.update(chunk)
-                    irods_sha1.update(chunk)
-                    total_bytes += len(chunk)
-                    yield
-            buff.close()
-
-            sha1_hexdigest = irods_sha1.hexdigest()
-            sha_hexdigest = irods_sha256.hexdigest()
-            upload_success.update({f.path: sha_hexdigest})
-            # logger.info(f"{'--':<20}Buffer checksum {f.name}:")
-            # logger.info(f"{'--':<30}SHA-256: {sha256_hexdigest}")
-            # logger.info(f"{'--':<30}SHA-1: {sha1_hexdigest}")
-            checksum_list.append((arc_name.replace(f'{collection.name}/data', 'data'), sha1_hexdigest))
+    buffers = new_block_buffers()
+    files = (f for coll, sub, files in collection.walk() for f in files)
+    for f, buff in open_ahead(session, files):
+        total_files += 1
+        arc_name = f.path.replace(collection.path, f'{collection.name}/data')
+        zip_info = zipfile.ZipInfo(arc_name)
+        zip_info.file_size = f.size
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        irods_sha256 = hashlib.sha256()
+        irods_sha1 = hashlib.sha1()
+        with zip_buffer.open(zip_info, mode='w') as dest:
+            for chunk in read_blocks(buff, buffers, (irods_sha256, irods_sha1), f.size):
+                dest.write(chunk, )
+                total_bytes += len(chunk)
+                yield
+        buff.close()
+
+        sha1_hexdigest = irods_sha1.hexdigest()
+        sha_hexdigest = irods_sha256.hexdigest()
+        upload_success.update({f.path: sha_hexdigest})
+        # logger.info(f"{'--':<20}Buffer checksum {f.name}:")
+        # logger.info(f"{'--':<30}SHA-256: {sha256_hexdigest}")
+        # logger.info(f"{'--':<30}SHA-1: {sha1_hexdigest}")
+        checksum_list.append((arc_name.replace(f'{collection.name}/data', 'data'), sha1_hexdigest))
     yield
 
     tagmanifest = []
@@ -448,7 +649,7 @@ def bag_generator_faker(irods_client, upload_success, irods_md5):
     """
 
     stream = UnseekableStream()
-    bar = tqdm(total=100000000, unit="bytes", smoothing=0.1, unit_scale=True, disable=not debug)
+    bar = progress_bar(None)
     zip_iterator = bag_collection(irods_client, stream, upload_success)
     size_bundle = archive_generator_faker(zip_iterator, stream, bar, irods_md5)
 
@@ -468,9 +669,10 @@ def get_bag_generator(irods_client, upload_success, irods_md5, size) -> Iterator
 
     logger.info(f"{'--':<20}Bag predicted size: {size}")
     stream = UnseekableStream()
-    bar = tqdm(total=size, unit="bytes", smoothing=0.1, unit_scale=True, disable=not debug)
+    bar = progress_bar(size)
     zip_iterator = bag_collection(irods_client, stream, upload_success)
-    iterator = IteratorAsBinaryFile(size, archive_generator(zip_iterator, stream, bar), irods_md5)
+    archive_generator = make_archive_generator(debug)
+    iterator = IteratorAsBinaryFile(size, archive_generator(zip_iterator, stream, bar, irods_md5))
 
     return iterator
 
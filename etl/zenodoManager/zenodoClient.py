@@ -8,7 +8,7 @@ from irodsManager.irodsUtils import get_zip_generator, zip_generator_faker, Expo
 
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 from http import HTTPStatus
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger('iRODS to Dataverse')
 
@@ -30,8 +30,8 @@ class ZenodoClient(ExporterClient):
         self.session = irodsclient.session
         self.rulemanager = irodsclient.rulemanager
 
-        self.pool = None
-        self.result = None
+        self.executor = None
+        self.checksum_future = None
         self.irods_md5 = None
 
         self.deposition_status = None
@@ -68,8 +68,8 @@ class ZenodoClient(ExporterClient):
     def import_zip_collection(self):
         if self.deposition_url is not None:
             self.irods_client.update_metadata_state(Status.CREATE_DATASET.value, Status.PREPARE_COLLECTION.value)
-            self.pool = Pool(processes=1)
-            self.result = self.pool.apply_async(self.run_checksum, [self.collection.path])
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.checksum_future = self.executor.submit(self.run_checksum, self.collection.path)
 
             size_bundle = self._prepare_zip()
             response = self._zip_collection(size_bundle)
@@ -85,10 +85,8 @@ class ZenodoClient(ExporterClient):
         logger.info(f"{'--':<10}Prepare zip")
 
         self.irods_client.update_metadata_state(Status.PREPARE_COLLECTION.value, Status.ZIP_COLLECTION.value)
-        irods_md5 = hashlib.md5()
-        size_bundle = zip_generator_faker(self.irods_client, self.upload_success, irods_md5, self.restrict_list)
-        md5_hexdigest = irods_md5.hexdigest()
-        logger.info(f"{'--':<20}Buffer faker MD5: {md5_hexdigest}")
+        size_bundle = zip_generator_faker(self.irods_client, self.restrict_list)
+        logger.info(f"{'--':<20}Buffer faker size: {size_bundle}")
 
         return size_bundle
 
@@ -116,9 +114,8 @@ class ZenodoClient(ExporterClient):
         logger.info(f"{'--':<10}Validate checksum")
 
         self.irods_client.update_metadata_state(Status.UPLOAD_ZIPPED_COLLECTION.value, Status.VALIDATE_CHECKSUM.value)
-        self.pool.close()
-        self.pool.join()
-        chksums = self.result.get()
+        chksums = self.checksum_future.result()
+        self.executor.shutdown()
         count = 0
         validated = False
         for k in self.upload_success.keys():